@@ -1,15 +1,28 @@
 # app.py
 # Flask webapp: subes una imagen (orden ML) -> devuelve tabla (SKU, Título, Unidades, Marketplace, Envío)
-import io, re, unicodedata
-from typing import Dict, Any, List, Tuple
+import base64, csv, hashlib, html, io, multiprocessing, os, re, threading, unicodedata
+from concurrent.futures import ProcessPoolExecutor
+from concurrent.futures.process import BrokenProcessPool
+from typing import Dict, Any, List, Optional, Tuple
 
-from flask import Flask, request, render_template_string, send_file
-from PIL import Image, ImageFilter, ImageOps
-import pytesseract
-import pandas as pd
+import cv2
+import numpy as np
+from flask import Flask, request, send_file, session
+from PIL import Image, ImageOps
+
+import ocr_worker
 
 app = Flask(__name__)
 app.config["MAX_CONTENT_LENGTH"] = 6 * 1024 * 1024  # 6 MB
+# La última fila detectada viaja en la cookie de sesión (para /download).
+# Sin SECRET_KEY fija, la cookie no sirve en otra réplica ni tras reiniciar.
+app.secret_key = os.environ.get("SECRET_KEY")
+if not app.secret_key:
+    app.logger.warning(
+        "SECRET_KEY no definida: se usa una clave aleatoria y /download "
+        "fallará entre réplicas o tras reiniciar"
+    )
+    app.secret_key = os.urandom(32)
 
 # ====== CATÁLOGO (SKU -> Descripción Producto) ======
 CATALOGO_SKU: Dict[str, str] = {
@@ -22,18 +35,30 @@ CATALOGO_SKU: Dict[str, str] = {
     "7501468144501": "LECHELAK LECHE DE CABRA 340 G",
 }
 
+# Todo lo que no sea alfanumérico ni espacio (puntuación, marcas diacríticas tras NFKD, ®, °, ...)
+_NON_ALNUM = re.compile(r"[^\w\s]|_")
+
 # Precomputo tokens de descripciones para poder hacer match si no hay EAN
 def _normalize(txt: str) -> str:
-    return "".join(
-        c for c in unicodedata.normalize("NFKD", txt.lower())
-        if c.isalnum() or c.isspace()
-    )
+    return _NON_ALNUM.sub("", unicodedata.normalize("NFKD", txt.lower()))
 
-DESC_TOKENS = {
-    sku: set(_normalize(desc).split())
+DESC_TOKENS: Dict[str, frozenset] = {
+    sku: frozenset(_normalize(desc).split())
     for sku, desc in CATALOGO_SKU.items()
 }
 
+# Catálogo en arreglos paralelos: cada descripción es un bitmap sobre un
+# vocabulario común y el puntaje es popcount(tokens_ocr & tokens_desc).
+VOCAB: Dict[str, int] = {
+    tok: i for i, tok in enumerate(sorted(set().union(*DESC_TOKENS.values())))
+}
+_SKUS: Tuple[str, ...] = tuple(DESC_TOKENS)
+_DESC_BITS: Tuple[int, ...] = tuple(
+    sum(1 << VOCAB[t] for t in toks) for toks in DESC_TOKENS.values()
+)
+# Puntaje máximo posible: al alcanzarlo ya no hace falta seguir buscando
+_MAX_SCORE = max(db.bit_count() for db in _DESC_BITS)
+
 MARKETPLACE_CONST = "Mercadolibre"
 
 HTML = """
@@ -57,6 +82,7 @@ HTML = """
     .pill{background:#eef2ff;color:#3730a3;padding:4px 10px;border-radius:999px;font-size:12px}
     img{max-width:100%;height:auto;border-radius:12px;margin-top:12px}
     .grid{display:grid;grid-template-columns:1fr 1fr;gap:20px;margin-top:8px}
+    .error{color:#b91c1c;margin-top:12px}
     @media (max-width: 800px){.grid{grid-template-columns:1fr}}
   </style>
 </head>
@@ -70,20 +96,21 @@ HTML = """
       <button class="btn" type="submit">Procesar</button>
     </form>
 
+    {% if error %}
+    <p class="error">{{ error }}</p>
+    {% endif %}
+
     {% if preview %}
     <div class="grid">
       <div>
         <h3>Vista previa</h3>
-        <img src="data:image/png;base64,{{preview}}">
+        <img src="data:image/jpeg;base64,{{preview}}">
       </div>
       <div>
         <h3>Tabla detectada</h3>
         {{ table_html|safe }}
         <div style="margin-top:12px" class="row">
-          <form method="post" action="/download">
-            <input type="hidden" name="csv" value="{{csv_b64}}">
-            <button class="btn" type="submit">Descargar CSV</button>
-          </form>
+          <a class="btn" href="/download">Descargar CSV</a>
           <span class="pill">Filas: {{rows}}</span>
         </div>
         <details style="margin-top:14px">
@@ -97,40 +124,90 @@ HTML = """
 </body>
 </html>
 """
+# Se compila una sola vez; render_template_string re-parsea en cada request
+_TMPL = app.jinja_env.from_string(HTML)
 
-def preprocess(img: Image.Image) -> Image.Image:
-    g = ImageOps.grayscale(img)
-    g = ImageOps.autocontrast(g)
-    g = g.filter(ImageFilter.MedianFilter(size=3))
-    w, h = g.size
+def preprocess(img: Image.Image) -> np.ndarray:
+    # Gris + CLAHE (mejor que autocontrast con iluminación no uniforme)
+    g = cv2.cvtColor(np.asarray(img), cv2.COLOR_RGB2GRAY)
+    # Un CLAHE por llamada: guarda buffers internos y no es seguro entre hilos
+    g = cv2.createCLAHE(clipLimit=2.0, tileGridSize=(8, 8)).apply(g)
+    g = cv2.medianBlur(g, 3)
+    h, w = g.shape
     if max(w, h) > 1800:
         scale = 1800 / max(w, h)
-        g = g.resize((int(w * scale), int(h * scale)))
-    return g
+        g = cv2.resize(g, (int(w * scale), int(h * scale)), interpolation=cv2.INTER_AREA)
+    # Binarización Otsu: umbral global sobre la imagen ya ecualizada con CLAHE
+    _, bw = cv2.threshold(g, 0, 255, cv2.THRESH_BINARY | cv2.THRESH_OTSU)
+    return bw
 
-def ocr_text_from_image(pil_img: Image.Image) -> str:
+# Tesseract corre en un pool de procesos (ver ocr_worker.py) y el worker de
+# Flask queda libre mientras se hace el OCR. Cada hijo carga ~100 MB (modelo
+# LSTM + numpy), por eso el default es pequeño y se sube con OCR_WORKERS.
+# Los hijos ("spawn") solo importan ocr_worker; si se lanza con `python app.py`
+# además re-ejecutan este archivo como __mp_main__, por eso el Dockerfile usa
+# `flask run`.
+OCR_WORKERS = int(os.environ.get("OCR_WORKERS", 2))
+_POOL: Optional[ProcessPoolExecutor] = None
+_POOL_LOCK = threading.Lock()
+
+def _get_pool() -> ProcessPoolExecutor:
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is None:
+            _POOL = ProcessPoolExecutor(
+                max_workers=OCR_WORKERS,
+                mp_context=multiprocessing.get_context("spawn"),
+                initializer=ocr_worker.init_worker,
+            )
+        return _POOL
+
+def _discard_pool(broken: ProcessPoolExecutor) -> None:
+    # Otro hilo pudo haberlo reemplazado ya; solo se descarta si sigue siendo el actual
+    global _POOL
+    with _POOL_LOCK:
+        if _POOL is broken:
+            _POOL = None
+    broken.shutdown(wait=False, cancel_futures=True)
+
+def ocr_text_from_image(gray: np.ndarray) -> str:
     # OCR más robusto en español
-    return pytesseract.image_to_string(
-        pil_img, lang="spa", config="--oem 1 --psm 6"
-    )
+    pool = _get_pool()
+    try:
+        return pool.submit(ocr_worker.ocr, gray).result()
+    except BrokenProcessPool:
+        # Un hijo murió (p. ej. segfault de Tesseract): se rehace el pool y se reintenta una vez
+        _discard_pool(pool)
+        return _get_pool().submit(ocr_worker.ocr, gray).result()
 
-EAN13_RE = re.compile(r"\b(7\d{12})\b")
-UNITS_RE = re.compile(r"(\d+)\s*(?:unid(?:ad|ades)?)\b", re.IGNORECASE)
+# \d, \s y \b solo ASCII en EAN y unidades (re.ASCII)
+EAN13_RE = re.compile(r"\b(7\d{12})\b", re.ASCII)
+UNITS_RE = re.compile(r"(\d+)\s*(?:unid(?:ad|ades)?)\b", re.IGNORECASE | re.ASCII)
 ENVIO_LINE_RE = re.compile(r"(env[ií]o[^\n]{0,60})", re.IGNORECASE)
+# Colapsa espacios/tabs repetidos, solo dentro de la línea de envío capturada
+_WS = re.compile(r"[ \t]+")
 
 def best_catalog_match(ocr_text: str) -> Tuple[str, str]:
     """
-    Cuando NO hay EAN: calcula intersección de tokens del OCR contra
-    los tokens de cada descripción de catálogo y devuelve el mejor.
+    Cuando NO hay EAN: arma el bitmap de tokens del OCR, lo cruza con el de
+    cada descripción de catálogo y devuelve la de mayor puntaje.
     """
-    tokens_text = set(_normalize(ocr_text).split())
-    best_sku, best_desc, best_score = "", "", 0
-    for sku, desc_tokens in DESC_TOKENS.items():
-        score = len(tokens_text & desc_tokens)
+    tb = 0
+    for t in _normalize(ocr_text).split():
+        i = VOCAB.get(t)
+        if i is not None:
+            tb |= 1 << i
+    best_i, best_score = -1, 0
+    for i, db in enumerate(_DESC_BITS):
+        score = (tb & db).bit_count()
         if score > best_score:
-            best_score = score
-            best_sku, best_desc = sku, CATALOGO_SKU[sku]
-    return best_sku, best_desc
+            best_i, best_score = i, score
+            if best_score == _MAX_SCORE:
+                break
+    if best_i < 0:
+        return "", ""
+    sku = _SKUS[best_i]
+    return sku, CATALOGO_SKU[sku]
 
 def extract_fields(full_text: str) -> Dict[str, Any]:
     # Unidades
@@ -138,8 +215,8 @@ def extract_fields(full_text: str) -> Dict[str, Any]:
     unidades = int(m_u.group(1)) if m_u else 1
 
     # Envío
-    m_env = ENVIO_LINE_RE.search(full_text.replace("  ", " "))
-    envio = m_env.group(1).strip() if m_env else "Mercado Envíos"
+    m_env = ENVIO_LINE_RE.search(full_text)
+    envio = _WS.sub(" ", m_env.group(1)).strip() if m_env else "Mercado Envíos"
 
     # SKU por EAN
     m_ean = EAN13_RE.search(full_text)
@@ -160,60 +237,103 @@ def extract_fields(full_text: str) -> Dict[str, Any]:
         "Envío": envio,
     }
 
-def img_to_base64(pil_img: Image.Image) -> str:
-    import base64
+def img_to_jpeg(pil_img: Image.Image) -> io.BytesIO:
+    # Vista previa reducida (máx. 800 px) en JPEG: mucho más rápida y ligera que PNG.
+    # Se genera directo a 800 px (sin copiar la imagen completa) y nunca se amplía.
     buf = io.BytesIO()
-    pil_img.save(buf, format="PNG")
-    return base64.b64encode(buf.getvalue()).decode("utf-8")
+    thumb = pil_img
+    if max(pil_img.size) > 800:
+        thumb = ImageOps.contain(pil_img, (800, 800), Image.BILINEAR)
+    try:
+        thumb.save(buf, format="JPEG", quality=80)
+    finally:
+        if thumb is not pil_img:
+            thumb.close()
+    # Se devuelve el buffer (no getvalue()) para codificarlo sin otra copia
+    return buf
 
-def df_to_b64_csv(df: pd.DataFrame) -> str:
-    import base64
-    csv = df.to_csv(index=False, encoding="utf-8-sig")
-    return base64.b64encode(csv.encode("utf-8-sig")).decode("utf-8")
+def row_to_html(row: Dict[str, Any]) -> str:
+    # Tabla de una sola fila, sin pandas
+    head = "".join(f"<th>{html.escape(c)}</th>" for c in row)
+    body = "".join(f"<td>{html.escape(str(v))}</td>" for v in row.values())
+    return f"<table><thead><tr>{head}</tr></thead><tbody><tr>{body}</tr></tbody></table>"
+
+def row_to_csv(row: Dict[str, Any]) -> bytes:
+    buf = io.StringIO()
+    w = csv.writer(buf)
+    w.writerow(row.keys())
+    w.writerow(row.values())
+    return buf.getvalue().encode("utf-8-sig")
 
 @app.route("/", methods=["GET", "POST"])
 def index():
     if request.method == "GET":
-        return render_template_string(HTML, preview=None)
+        return _TMPL.render(preview=None)
     file = request.files.get("image")
     if not file:
-        return render_template_string(HTML, preview=None)
+        return _TMPL.render(preview=None)
 
-    img = Image.open(file.stream).convert("RGB")
-    pre = preprocess(img)
-    text = ocr_text_from_image(pre)
+    with Image.open(file.stream) as src:
+        # En JPEG, libjpeg decodifica directamente a escala reducida (1/2, 1/4, 1/8)
+        src.draft("RGB", (1600, 1600))
+        img = src if src.mode == "RGB" else src.convert("RGB")
+        try:
+            pre = preprocess(img)
+            text = ocr_text_from_image(pre)
+            # Vista previa inline: sin estado en el servidor, sirve en cualquier réplica
+            preview_b64 = base64.b64encode(img_to_jpeg(img).getbuffer()).decode("ascii")
+        finally:
+            if img is not src:
+                img.close()
 
     row = extract_fields(text)
-    df = pd.DataFrame([row])
 
-    table_html = df.to_html(index=False)
-    preview_b64 = img_to_base64(img)
-    csv_b64 = df_to_b64_csv(df)
+    table_html = row_to_html(row)
+    # Pares (columna, valor): conserva el orden de columnas en la sesión
+    session["last_row"] = list(row.items())
 
-    return render_template_string(
-        HTML,
+    return _TMPL.render(
         preview=preview_b64,
         table_html=table_html,
         ocr_text=text,
-        rows=len(df),
-        csv_b64=csv_b64,
+        rows=1,
     )
 
-@app.route("/download", methods=["POST"])
+@app.route("/download", methods=["GET"])
 def download_csv():
-    import base64
-    csv_b64 = request.form.get("csv", "")
-    if not csv_b64:
+    pairs = session.get("last_row")
+    if not pairs:
         return "No hay datos", 400
-    raw = base64.b64decode(csv_b64)
+    raw = row_to_csv(dict(pairs))
     return send_file(
         io.BytesIO(raw),
         mimetype="text/csv; charset=utf-8",
         as_attachment=True,
         download_name="orden_ocr.csv",
+        conditional=True,
+        etag=hashlib.md5(raw).hexdigest(),
     )
 
+@app.errorhandler(413)
+def too_large(_err):
+    return _TMPL.render(preview=None, error="La imagen supera el límite de 6 MB."), 413
+
+def warm_ocr_pool() -> None:
+    # Con "spawn" el pool crea un hijo por submit que no encuentra uno libre:
+    # se envían OCR_WORKERS tareas vacías seguidas (ninguna termina antes de que
+    # arranque el siguiente hijo) y luego se espera a todas. Si falla el
+    # initializer (p. ej. falta spa.traineddata) se lanza BrokenProcessPool aquí.
+    pool = _get_pool()
+    for fut in [pool.submit(int) for _ in range(OCR_WORKERS)]:
+        fut.result()
+
+# Se arranca al importar el módulo, para que un fallo de Tesseract tumbe el
+# proceso al inicio y no en la primera subida. Ojo: cualquier `import app`
+# (`flask routes`, `flask shell`, scripts) también levanta los procesos de OCR.
+# No aplica a la copia __mp_main__ que "spawn" ejecuta dentro de cada hijo.
+if __name__ != "__mp_main__":
+    warm_ocr_pool()
+
 if __name__ == "__main__":
-    import os
     port = int(os.environ.get("PORT", 8000))
     app.run(host="0.0.0.0", port=port, debug=False)
@@ -0,0 +1,31 @@
+# ocr_worker.py
+# Lado "hijo" del pool de OCR: solo depende de tesserocr y numpy, para que los
+# procesos del pool no carguen Flask, OpenCV ni el resto de app.py.
+import numpy as np
+from tesserocr import PyTessBaseAPI, OEM, PSM
+
+# Solo los caracteres que aparecen en las órdenes: menos candidatos para el decodificador
+TESS_WHITELIST = (
+    "0123456789"
+    "ABCDEFGHIJKLMNOPQRSTUVWXYZabcdefghijklmnopqrstuvwxyz"
+    "ÁÉÍÓÚÑáéíóúñ .,-/()"
+)
+TESS_VARIABLES = {
+    "tessedit_do_invert": "0",
+    "tessedit_char_whitelist": TESS_WHITELIST,
+}
+
+# Una API por proceso: el modelo LSTM se carga una sola vez y no hace falta lock
+_API = None
+
+def init_worker() -> None:
+    global _API
+    _API = PyTessBaseAPI(
+        lang="spa", oem=OEM.LSTM_ONLY, psm=PSM.SINGLE_BLOCK, variables=TESS_VARIABLES
+    )
+
+def ocr(gray: np.ndarray) -> str:
+    # El ndarray (8 bits, 1 canal) va directo a Tesseract
+    h, w = gray.shape
+    _API.SetImageBytes(gray.tobytes(), w, h, 1, w)
+    return _API.GetUTF8Text()